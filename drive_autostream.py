@@ -8,27 +8,210 @@ to one or more RTMP targets.
 from __future__ import annotations
 
 import argparse
+import asyncio
+import bisect
+import contextlib
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import re
 import shutil
+import struct
 import subprocess
 import sys
-import time
-from dataclasses import dataclass
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass, replace
+from functools import cached_property
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+)
 
+import google_auth_httplib2
+import httplib2
+import requests
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import set_user_agent
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+LOG_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
+# googleapiclient itself asks for gzip and appends "(gzip)" to this agent.
+USER_AGENT = 'xstream-drive-autostream'
+# Socket timeout for Drive API calls, which page through up to 1000 entries.
+API_TIMEOUT = 60
+CHANGE_FIELDS = (
+    'nextPageToken,newStartPageToken,'
+    'changes(fileId,removed,file(id,name,mimeType,parents,trashed,md5Checksum))'
+)
+DOWNLOAD_URL = 'https://drive.google.com/uc?export=download&id={file_id}'
+
+# Drive downloads are split into byte ranges fetched over a shared keep-alive
+# session. At most RANGE_WORKERS * 2 chunks are held in memory at once, plus
+# the PREFETCH_BYTES head of the next video buffered during playback.
+RANGE_CHUNK_SIZE = 4 << 20
+RANGE_WORKERS = 4
+PREFETCH_BYTES = 8 << 20
+DOWNLOAD_TIMEOUT = 30
+
+# ffmpeg can only read an MP4/MOV from a pipe when its moov index comes
+# before the media data, so the first LAYOUT_PROBE_BYTES of every file are
+# checked. ISO BMFF files start with one of MP4_LEADING_BOXES.
+LAYOUT_PROBE_BYTES = 64 << 10
+MP4_LEADING_BOXES = frozenset(
+    {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid'}
+)
+
+# Pipes to and from ffmpeg are enlarged so neither side stalls on a full
+# 64 KiB kernel buffer. ffmpeg's stderr is drained in STDERR_READ_SIZE reads
+# and only its last FFMPEG_LOG_BYTES are kept, to report the final
+# FFMPEG_LOG_TAIL lines when it fails.
+PIPE_BUFFER_SIZE = 1 << 20
+STDERR_READ_SIZE = 1 << 16
+FFMPEG_LOG_BYTES = 1 << 16
+FFMPEG_LOG_TAIL = 20
+
+# H.264 encoders in order of preference. Hardware encoders are only picked
+# when a one-frame trial encode succeeds on this host.
+VIDEO_ENCODERS: Dict[str, Tuple[str, ...]] = {
+    'h264_nvenc': ('-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll'),
+    'h264_qsv': ('-c:v', 'h264_qsv', '-preset', 'veryfast'),
+    'h264_vaapi': (
+        '-vaapi_device', '/dev/dri/renderD128',
+        '-vf', 'format=nv12,hwupload',
+        '-c:v', 'h264_vaapi',
+    ),
+    'h264_videotoolbox': ('-c:v', 'h264_videotoolbox', '-realtime', '1'),
+    'libx264': ('-c:v', 'libx264', '-preset', 'veryfast'),
+}
+AUDIO_ENCODE_ARGS = ('-c:a', 'aac', '-ar', '44100', '-b:a', '128k')
+# libx264 thread cap per ffmpeg when several channels share the host's cores.
+# Hardware encoders ignore -threads, and a lone channel uses every core.
+ENCODER_THREADS = 4
+
+# Sources that already satisfy flv are relayed as-is instead of re-encoded.
+PASSTHROUGH_CODECS = ('h264', 'aac')
+PASSTHROUGH_ARGS = ('-c:v', 'copy', '-c:a', 'copy', '-bsf:a', 'aac_adtstoasc')
+PROBE_ENTRIES = (
+    'codec_type,codec_name,width,height,pix_fmt,profile,sample_rate,channels'
+)
+# A file whose probe keeps failing is retried on this many passes in total.
+PROBE_ATTEMPTS = 3
+# Files whose format and layout are settled before their session starts;
+# the rest of a pass is settled in the background while it plays.
+SETTLE_AHEAD = 4
+
+# Tee outputs are muxed per destination: MPEG-TS for SRT/UDP legs and flv
+# for everything else (RTMP).
+TEE_MUXERS = {'srt': 'mpegts', 'udp': 'mpegts'}
+
+# A pass in which no ffmpeg session exited cleanly is followed by a wait of
+# RETRY_DELAY seconds, doubled after each further failed pass and capped at
+# the refresh interval, so a broken output is not retried in a tight loop.
+RETRY_DELAY = 5
 
 
 class ConfigurationError(RuntimeError):
     """Raised when required configuration is missing or invalid."""
 
 
+@dataclass(frozen=True)
+class PrefetchedHead:
+    """Leading bytes of a download fetched ahead of playback."""
+
+    url: str
+    data: bytes
+    total: int | None = None
+
+
+@dataclass(frozen=True)
+class SourceFormat:
+    """Stream parameters ffprobe reports for a source file.
+
+    Stream copy across concat entries keeps the first file's codec
+    parameters, so it is only safe between files whose formats are equal.
+    """
+
+    video_codec: str | None = None
+    width: int | None = None
+    height: int | None = None
+    pix_fmt: str | None = None
+    profile: str | None = None
+    audio_codec: str | None = None
+    sample_rate: str | None = None
+    channels: int | None = None
+
+    @property
+    def passthrough(self) -> bool:
+        return (self.video_codec, self.audio_codec) == PASSTHROUGH_CODECS
+
+
+@dataclass(frozen=True)
+class ArgvTemplate:
+    """ffmpeg argv specialised for one config, around the playlist path.
+
+    Every piece is pre-encoded bytes, so a playlist pass only splices its
+    playlist path between ``prefix`` and the chosen suffix.
+    """
+
+    prefix: Tuple[bytes, ...]
+    encode_suffix: Tuple[bytes, ...]
+    passthrough_suffix: Tuple[bytes, ...]
+
+    def build(self, playlist: Path, *, passthrough: bool) -> Tuple[bytes, ...]:
+        suffix = self.passthrough_suffix if passthrough else self.encode_suffix
+        return (*self.prefix, os.fsencode(playlist), *suffix)
+
+
+class OutputTail:
+    """Bounded buffer of the most recent bytes a subprocess wrote.
+
+    Output is stored as raw chunks and only decoded when asked for.
+    """
+
+    def __init__(self, limit: int = FFMPEG_LOG_BYTES) -> None:
+        self._chunks: deque = deque()
+        self._size = 0
+        self._limit = limit
+
+    def append(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self._limit:
+            self._size -= len(self._chunks.popleft())
+
+    def lines(self, count: int = FFMPEG_LOG_TAIL) -> List[str]:
+        """Decode and return the last ``count`` lines, progress updates included."""
+
+        text = b''.join(self._chunks).decode(errors='replace').strip()
+        return re.split(r'[\r\n]+', text)[-count:] if text else []
+
+
 @dataclass(frozen=True)
 class StreamConfig:
     """Holds all values required to authenticate and stream videos."""
@@ -39,6 +222,12 @@ class StreamConfig:
     stream_key: str = 'stream'
     youtube_url: str | None = None
     twitch_url: str | None = None
+    local_url: str | None = None
+    video_encoder: str = 'auto'
+    state_dir: Path = Path.home() / '.cache' / 'xstream'
+    extra_channels: Tuple[Tuple[str, str], ...] = ()
+    max_streams: int = 1
+    share_cores: bool = False
 
     @classmethod
     def from_sources(cls, args: argparse.Namespace) -> 'StreamConfig':
@@ -63,22 +252,80 @@ class StreamConfig:
 
         refresh_interval = _parse_refresh_interval(args.refresh_interval)
 
+        video_encoder = args.video_encoder or os.getenv('VIDEO_ENCODER', 'auto')
+        if video_encoder != 'auto' and video_encoder not in VIDEO_ENCODERS:
+            raise ConfigurationError(
+                f"Unsupported video encoder '{video_encoder}'. Choose 'auto' or "
+                f"one of: {', '.join(VIDEO_ENCODERS)}."
+            )
+
+        state_dir = args.state_dir or os.getenv('STATE_DIR')
+
+        stream_key = args.stream_key or os.getenv('RTMP_STREAM_KEY', 'stream')
+        channel_specs = args.channel or [
+            spec for spec in os.getenv('CHANNELS', '').split(',') if spec.strip()
+        ]
+        extra_channels = tuple(_parse_channel(spec) for spec in channel_specs)
+        stream_keys = [stream_key, *(key for _, key in extra_channels)]
+        if len(set(stream_keys)) != len(stream_keys):
+            raise ConfigurationError(
+                'Every channel needs its own stream key; '
+                f"got {', '.join(stream_keys)}."
+            )
+
         return cls(
             folder_id=folder_id,
             service_account_file=service_account_path,
             refresh_interval=refresh_interval,
-            stream_key=args.stream_key or os.getenv('RTMP_STREAM_KEY', 'stream'),
+            stream_key=stream_key,
             youtube_url=args.youtube_url or os.getenv('YOUTUBE_URL') or None,
             twitch_url=args.twitch_url or os.getenv('TWITCH_URL') or None,
+            local_url=args.local_url or os.getenv('LOCAL_OUTPUT_URL') or None,
+            video_encoder=video_encoder,
+            state_dir=Path(state_dir).expanduser() if state_dir else cls.state_dir,
+            extra_channels=extra_channels,
+            max_streams=_parse_max_streams(args.max_streams),
         )
 
+    def channel_configs(self) -> List['StreamConfig']:
+        """Split into one config per channel.
+
+        Extra channels only publish to the local RTMP server under their own
+        stream key and keep their Drive state in a separate directory. With
+        more than one channel, every channel caps its encoder threads.
+        """
+
+        share_cores = bool(self.extra_channels)
+        channels = [replace(self, extra_channels=(), share_cores=share_cores)]
+        for folder_id, stream_key in self.extra_channels:
+            channels.append(
+                replace(
+                    self,
+                    folder_id=folder_id,
+                    stream_key=stream_key,
+                    youtube_url=None,
+                    twitch_url=None,
+                    local_url=None,
+                    state_dir=self.state_dir / stream_key,
+                    extra_channels=(),
+                    share_cores=share_cores,
+                )
+            )
+        return channels
+
     @property
-    def local_rtmp_url(self) -> str:
-        return f"rtmp://localhost/live/{self.stream_key}"
+    def local_output_url(self) -> str:
+        return self.local_url or f"rtmp://localhost/live/{self.stream_key}"
+
+    @cached_property
+    def tee_output(self) -> bytes:
+        """The ffmpeg tee muxer argument, encoded once for exec."""
+
+        return build_tee_output(self.tee_targets)
 
     @property
     def tee_targets(self) -> List[str]:
-        targets: List[str] = [self.local_rtmp_url]
+        targets: List[str] = [self.local_output_url]
         if self.youtube_url:
             targets.append(self.youtube_url)
         if self.twitch_url:
@@ -106,82 +353,1120 @@ def _parse_refresh_interval(cli_value: int | None) -> int:
     return refresh_interval
 
 
-def ensure_ffmpeg_available() -> None:
-    """Verify ffmpeg is on PATH before attempting to stream."""
+def _parse_channel(spec: str) -> Tuple[str, str]:
+    """Split a ``FOLDER_ID:STREAM_KEY`` channel specification."""
 
-    if shutil.which('ffmpeg') is None:
+    folder_id, _, stream_key = spec.strip().partition(':')
+    if not folder_id or not stream_key:
+        raise ConfigurationError(
+            f"Invalid channel '{spec}'. Use the form FOLDER_ID:STREAM_KEY."
+        )
+    # The key also names the channel's state directory under state_dir.
+    if '/' in stream_key or '\\' in stream_key or stream_key in ('.', '..'):
+        raise ConfigurationError(
+            f"Invalid stream key '{stream_key}' in channel '{spec}'. Stream keys "
+            "cannot contain '/' or '\\' or be '.' or '..'."
+        )
+    return folder_id, stream_key
+
+
+def _parse_max_streams(cli_value: int | None) -> int:
+    """Resolve how many channels may run ffmpeg at once."""
+
+    if cli_value is not None:
+        max_streams = cli_value
+    else:
+        default = max(1, (os.cpu_count() or 1) // ENCODER_THREADS)
+        max_streams_str = os.getenv('MAX_STREAMS', str(default))
+        try:
+            max_streams = int(max_streams_str)
+        except ValueError as exc:  # noqa: B904 - add context for the user
+            raise ConfigurationError(
+                f"MAX_STREAMS must be an integer, got '{max_streams_str}'."
+            ) from exc
+
+    if max_streams <= 0:
+        raise ConfigurationError('Max streams must be a positive integer.')
+
+    return max_streams
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_executable(name: str) -> str | None:
+    """Return the absolute path of ``name`` on PATH, searching only once."""
+
+    path = shutil.which(name)
+    return os.path.abspath(path) if path else None
+
+
+def ensure_ffmpeg_available() -> str:
+    """Verify ffmpeg is on PATH before attempting to stream.
+
+    Returns the absolute path so commands can skip the PATH search at exec.
+    """
+
+    ffmpeg = _resolve_executable('ffmpeg')
+    if ffmpeg is None:
         raise ConfigurationError(
             'ffmpeg executable not found on PATH. Install ffmpeg and retry.'
         )
+    return ffmpeg
+
+
+def _encoder_works(encoder: str) -> bool:
+    """Run a one-frame trial encode to confirm the encoder's hardware exists."""
+
+    trial_cmd = [
+        ensure_ffmpeg_available(), '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=size=256x256:rate=1',
+        '-frames:v', '1', *VIDEO_ENCODERS[encoder], '-f', 'null', '-',
+    ]
+    try:
+        result = subprocess.run(
+            trial_cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=15,
+            check=False,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+@functools.lru_cache(maxsize=None)
+def select_video_encoder(preference: str = 'auto') -> str:
+    """Pick the H.264 encoder to use, preferring available hardware.
+
+    An explicit preference is returned unchanged. ``auto`` checks the
+    encoders compiled into ffmpeg once and returns the first hardware
+    encoder that can actually encode on this host, else ``libx264``.
+    """
+
+    if preference != 'auto':
+        return preference
+
+    try:
+        listing = subprocess.run(
+            [ensure_ffmpeg_available(), '-hide_banner', '-encoders'],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            check=False,
+        ).stdout
+    except OSError:
+        listing = ''
+    compiled = {
+        fields[1]
+        for fields in map(str.split, listing.splitlines())
+        if len(fields) > 1
+    }
+
+    for encoder in VIDEO_ENCODERS:
+        if encoder == 'libx264':
+            break
+        if encoder in compiled and _encoder_works(encoder):
+            return encoder
+    return 'libx264'
+
+
+def probe_source(url: str) -> SourceFormat:
+    """Return the format of the first video and audio streams in ``url``.
+
+    Raises ``OSError``, ``subprocess.SubprocessError`` or ``ValueError`` when
+    the probe fails.
+    """
+
+    result = subprocess.run(
+        [
+            _resolve_executable('ffprobe') or 'ffprobe',
+            '-v', 'quiet', '-print_format', 'json',
+            '-show_entries', f'stream={PROBE_ENTRIES}', url,
+        ],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        check=True,
+        close_fds=False,
+    )
+    streams: Dict[str, Dict] = {}
+    for stream in json.loads(result.stdout).get('streams', []):
+        streams.setdefault(stream.get('codec_type'), stream)
+    video = streams.get('video', {})
+    audio = streams.get('audio', {})
+    return SourceFormat(
+        video_codec=video.get('codec_name'),
+        width=video.get('width'),
+        height=video.get('height'),
+        pix_fmt=video.get('pix_fmt'),
+        profile=video.get('profile'),
+        audio_codec=audio.get('codec_name'),
+        sample_rate=audio.get('sample_rate'),
+        channels=audio.get('channels'),
+    )
+
+
+SourceKey = Tuple[str, 'str | None']
+
+
+def _source_key(file_info: Dict[str, str]) -> SourceKey:
+    """Identify one revision of a Drive file by its ID and content checksum."""
+
+    return file_info['id'], file_info.get('md5Checksum')
+
+
+class SourceCatalog:
+    """Stream formats and container layout of the Drive files seen so far.
+
+    Entries are keyed by file ID and checksum, so uploading a new revision
+    of a file has it checked again. The format decides which concat session
+    a file joins, and the layout decides between a FIFO and a URL entry.
+    Files are settled RANGE_WORKERS at a time on the catalog's own pool:
+    ``settle`` waits for the files a session is about to play, while
+    ``settle_later`` queues the rest of a pass behind them.
+    """
+
+    def __init__(self) -> None:
+        self._formats: Dict[SourceKey, SourceFormat] = {}
+        self._probe_failures: Dict[SourceKey, int] = {}
+        self._pipe_safe: Dict[SourceKey, bool] = {}
+        # Files that failed this pass wait for the next one to be retried.
+        self._failed_this_pass: set = set()
+        self._settling: Dict[SourceKey, Future] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=RANGE_WORKERS)
+        self._session = open_download_session()
+        self._closed = threading.Event()
+
+    def can_stream_copy(self, files: List[Dict[str, str]]) -> bool:
+        """Return True when every file is H.264/AAC in one identical format."""
+
+        formats = {self._formats.get(_source_key(file_info)) for file_info in files}
+        if len(formats) != 1:
+            return False
+        (source_format,) = formats
+        return source_format is not None and source_format.passthrough
+
+    def group(self, files: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        """Split ``files`` into groups that one concat session can play.
+
+        The concat demuxer sets each stream up from the first file it opens,
+        so a group is a run of consecutive files in one known format. Files
+        not probed yet, or whose probe failed, are played on their own.
+        """
+
+        groups: List[List[Dict[str, str]]] = []
+        previous: SourceFormat | None = None
+        for file_info in files:
+            source_format = self._formats.get(_source_key(file_info))
+            if groups and source_format is not None and source_format == previous:
+                groups[-1].append(file_info)
+            else:
+                groups.append([file_info])
+            previous = source_format
+        return groups
+
+    def can_pipe(self, file_info: Dict[str, str]) -> bool:
+        """Return True when the file is known to demux from a FIFO."""
+
+        return self._pipe_safe.get(_source_key(file_info), False)
+
+    def layout_known(self, file_info: Dict[str, str]) -> bool:
+        """Return True once the file's layout has been checked."""
+
+        return _source_key(file_info) in self._pipe_safe
+
+    def begin_pass(self) -> None:
+        """Allow files that failed during the previous pass to be retried."""
+
+        self._failed_this_pass.clear()
+
+    def settle(self, files: Iterable[Dict[str, str]]) -> None:
+        """Check the format and layout of unseen ``files`` and wait for them.
+
+        A failed probe is retried on later passes, up to PROBE_ATTEMPTS in
+        total; a failed layout check is retried on every later pass, and
+        the file is listed by URL meanwhile.
+        """
+
+        wait([future for future in map(self._schedule, files) if future])
+
+    def settle_later(self, files: Iterable[Dict[str, str]]) -> None:
+        """Queue unseen ``files`` to be settled in the background, in order."""
+
+        for file_info in files:
+            self._schedule(file_info)
+
+    def _schedule(self, file_info: Dict[str, str]) -> Future | None:
+        key = _source_key(file_info)
+        with self._lock:
+            future = self._settling.get(key)
+            if future is not None or self._closed.is_set() or self._settled(key):
+                return future
+            future = self._pool.submit(self._settle, key)
+            self._settling[key] = future
+        future.add_done_callback(lambda _: self._settling.pop(key, None))
+        return future
+
+    def _settled(self, key: SourceKey) -> bool:
+        if key in self._failed_this_pass:
+            return True
+        probed = (
+            key in self._formats
+            or self._probe_failures.get(key, 0) >= PROBE_ATTEMPTS
+        )
+        return probed and (key in self._pipe_safe or not hasattr(os, 'mkfifo'))
+
+    def _settle(self, key: SourceKey) -> None:
+        if self._closed.is_set():
+            return
+        url = DOWNLOAD_URL.format(file_id=key[0])
+        # The layout goes first: a file is only grouped once its format is
+        # known, and by then its session can already tell FIFO from URL.
+        if hasattr(os, 'mkfifo') and key not in self._pipe_safe:
+            self._check_layout(key, url)
+        if key not in self._formats:
+            self._probe(key, url)
+
+    def _probe(self, key: SourceKey, url: str) -> None:
+        if self._probe_failures.get(key, 0) >= PROBE_ATTEMPTS:
+            return
+        try:
+            self._formats[key] = probe_source(url)
+        except (OSError, subprocess.SubprocessError, ValueError) as exc:
+            logging.debug("Unable to probe %s: %s", url, exc)
+            self._failed_this_pass.add(key)
+            failures = self._probe_failures.get(key, 0) + 1
+            self._probe_failures[key] = failures
+            if failures == PROBE_ATTEMPTS:
+                logging.warning(
+                    "Giving up on probing %s; it will be re-encoded on its own.", url
+                )
+        else:
+            self._probe_failures.pop(key, None)
+
+    def _check_layout(self, key: SourceKey, url: str) -> None:
+        try:
+            self._pipe_safe[key] = is_pipe_safe(fetch_header(self._session, url))
+        except requests.RequestException as exc:
+            logging.debug("Unable to check the layout of %s: %s", url, exc)
+            self._failed_this_pass.add(key)
+
+    def close(self) -> None:
+        """Drop queued checks; those already running finish on their own."""
+
+        with self._lock:
+            self._closed.set()
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
 
 
 def load_drive_service(config: StreamConfig):
-    """Create an authenticated Google Drive service client."""
+    """Create an authenticated Google Drive service client.
+
+    The Drive discovery document bundled with google-api-python-client is
+    used, so startup makes no discovery request. All API calls share one
+    keep-alive ``httplib2`` connection.
+    """
 
     credentials = service_account.Credentials.from_service_account_file(
         str(config.service_account_file), scopes=SCOPES
     )
-    return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+    http = google_auth_httplib2.AuthorizedHttp(
+        credentials,
+        http=set_user_agent(httplib2.Http(timeout=API_TIMEOUT), USER_AGENT),
+    )
+    return build('drive', 'v3', http=http, static_discovery=True)
 
 
 def fetch_drive_videos(drive_service, folder_id: str) -> List[Dict[str, str]]:
-    """Retrieve video metadata for the configured folder."""
+    """Retrieve video metadata for the configured folder in name order.
 
-    try:
+    Pages are followed until exhausted, so folders larger than a single
+    ``pageSize`` are listed completely. ``HttpError`` is left to the caller
+    so a failed listing is not mistaken for an empty folder.
+    """
+
+    files: List[Dict[str, str]] = []
+    page_token = None
+    while True:
         results = (
             drive_service
             .files()
             .list(
                 q=f"'{folder_id}' in parents and mimeType contains 'video/'",
                 pageSize=1000,
-                fields="files(id, name)",
+                fields='nextPageToken,files(id,name,md5Checksum)',
                 orderBy='name',
+                pageToken=page_token,
             )
             .execute()
         )
-    except HttpError as exc:
-        logging.warning("Failed to retrieve Drive files: %s", exc)
-        return []
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if page_token is None:
+            return files
 
-    files = results.get('files', [])
-    files.sort(key=lambda entry: entry.get('name', ''))
-    return files
 
+class DrivePlaylist:
+    """Videos in a Drive folder, kept current through the Changes API.
 
-def build_tee_output(targets: Iterable[str]) -> str:
-    """Construct the ffmpeg tee muxer string for the configured outputs."""
+    The folder is listed in full once; later refreshes only apply the
+    changes since the saved page token. The token and the listing it
+    belongs to are stored in ``state_dir`` so restarts resume incrementally.
+    The playlist is sorted by name once per listing, and files added later
+    are inserted in place rather than re-sorting the whole playlist.
+    """
 
-    return f"[f=flv]{'|'.join(targets)}"
+    def __init__(self, folder_id: str, state_dir: Path) -> None:
+        self.folder_id = folder_id
+        self._token_path = state_dir / 'page_token'
+        self._snapshot_path = state_dir / 'playlist.json'
+        self._files: Dict[str, Dict[str, str]] = {}
+        self._order: List[Dict[str, str]] = []
+        self._page_token: str | None = None
 
+    @property
+    def files(self) -> List[Dict[str, str]]:
+        return list(self._order)
 
-def stream_videos(files: List[Dict[str, str]], config: StreamConfig) -> None:
-    """Iterate through Drive files and relay each via ffmpeg."""
+    def refresh(self, drive_service) -> List[Dict[str, str]]:
+        """Bring the playlist up to date and return it in name order.
 
-    tee_output = build_tee_output(config.tee_targets)
-    for index, file_info in enumerate(files, start=1):
-        file_id = file_info['id']
-        name = file_info.get('name', file_id)
-        url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        logging.info("Streaming %s/%s: %s", index, len(files), name)
+        On API or network errors, timeouts included, the last known playlist
+        is returned unchanged. A page token Drive no longer accepts is
+        dropped and the folder is listed again.
+        """
 
-        ffmpeg_cmd = [
-            'ffmpeg', '-re', '-i', url,
-            '-c:v', 'libx264', '-preset', 'veryfast',
-            '-c:a', 'aac', '-ar', '44100', '-b:a', '128k',
-            '-f', 'tee', tee_output,
-        ]
+        try:
+            if self._page_token is None and not self._load_state():
+                self._resync(drive_service)
+            else:
+                self._catch_up(drive_service)
+        except (HttpError, TransportError, httplib2.HttpLib2Error, OSError) as exc:
+            logging.warning("Failed to retrieve Drive files: %s", exc)
+        return self.files
 
-        logging.debug("Running command: %s", ' '.join(ffmpeg_cmd))
+    def _resync(self, drive_service) -> None:
+        # Take the token first so changes made during the listing are replayed.
+        token = drive_service.changes().getStartPageToken().execute()
+        self._set_files(fetch_drive_videos(drive_service, self.folder_id))
+        self._page_token = token['startPageToken']
+        self._save_state()
+
+    def _catch_up(self, drive_service) -> None:
         try:
-            result = subprocess.run(ffmpeg_cmd, check=False, text=False)
-            if result.returncode != 0:
-                logging.warning(
-                    "ffmpeg exited with code %s while streaming %s.",
-                    result.returncode,
-                    name,
+            changed = self._apply_changes(drive_service)
+        except HttpError as exc:
+            if exc.resp.status not in (400, 404):
+                raise
+            logging.warning(
+                "Drive rejected the saved page token (HTTP %s); relisting the folder.",
+                exc.resp.status,
+            )
+            self._clear_state()
+            self._resync(drive_service)
+        else:
+            if changed:
+                self._save_state()
+
+    def _apply_changes(self, drive_service) -> bool:
+        """Patch the playlist with pending changes; return True if any applied."""
+
+        changed = False
+        token = self._page_token
+        while True:
+            response = (
+                drive_service
+                .changes()
+                .list(
+                    pageToken=token,
+                    spaces='drive',
+                    pageSize=1000,
+                    fields=CHANGE_FIELDS,
+                )
+                .execute()
+            )
+            for change in response.get('changes', []):
+                changed = self._apply_change(change) or changed
+            token = response.get('nextPageToken')
+            if token is None:
+                break
+
+        new_token = response.get('newStartPageToken', self._page_token)
+        changed = changed or new_token != self._page_token
+        self._page_token = new_token
+        return changed
+
+    def _apply_change(self, change: Dict) -> bool:
+        file_id = change.get('fileId')
+        entry = change.get('file') or {}
+        if (
+            not change.get('removed')
+            and not entry.get('trashed')
+            and self.folder_id in entry.get('parents', [])
+            and entry.get('mimeType', '').startswith('video/')
+        ):
+            updated = {'id': file_id, 'name': entry.get('name', file_id)}
+            if 'md5Checksum' in entry:
+                updated['md5Checksum'] = entry['md5Checksum']
+            if self._files.get(file_id) == updated:
+                return False
+            self._discard(file_id)
+            self._files[file_id] = updated
+            bisect.insort(self._order, updated, key=_playlist_key)
+            return True
+        return self._discard(file_id)
+
+    def _discard(self, file_id: str) -> bool:
+        entry = self._files.pop(file_id, None)
+        if entry is None:
+            return False
+        self._order.remove(entry)
+        return True
+
+    def _set_files(self, files: List[Dict[str, str]]) -> None:
+        # Drive's name order differs from Python's, which insort relies on.
+        self._order = sorted(files, key=_playlist_key)
+        self._files = {entry['id']: entry for entry in files}
+
+    def _load_state(self) -> bool:
+        """Restore the token and listing saved by a previous run, if any."""
+
+        try:
+            token = self._token_path.read_text(encoding='utf-8').strip()
+            snapshot = json.loads(self._snapshot_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return False
+        if not token or snapshot.get('folder_id') != self.folder_id:
+            return False
+
+        self._set_files(snapshot.get('files', []))
+        self._page_token = token
+        return True
+
+    def _clear_state(self) -> None:
+        """Forget the page token, in memory and on disk, with its listing."""
+
+        self._page_token = None
+        for path in (self._token_path, self._snapshot_path):
+            with contextlib.suppress(OSError):
+                path.unlink(missing_ok=True)
+
+    def _save_state(self) -> None:
+        snapshot = {'folder_id': self.folder_id, 'files': self._order}
+        try:
+            self._token_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write the listing before the token so a crash never pairs a new
+            # token with an old listing.
+            _write_atomic(self._snapshot_path, json.dumps(snapshot))
+            _write_atomic(self._token_path, self._page_token or '')
+        except OSError as exc:
+            logging.warning(
+                "Unable to save Drive state to %s: %s", self._token_path.parent, exc
+            )
+
+
+def _playlist_key(entry: Dict[str, str]) -> str:
+    return entry.get('name', '')
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.write_text(text, encoding='utf-8')
+    os.replace(temp_path, path)
+
+
+def build_tee_output(targets: Iterable[str]) -> bytes:
+    """Construct the ffmpeg tee muxer argument for the configured outputs.
+
+    Each target gets its own muxer, chosen from its URL scheme.
+    """
+
+    return b'|'.join(
+        b'[f=%s]%s' % (
+            TEE_MUXERS.get(target.partition(':')[0].lower(), 'flv').encode(),
+            os.fsencode(target),
+        )
+        for target in targets
+    )
+
+
+def _argv(*args: str) -> Tuple[bytes, ...]:
+    """Encode command-line arguments up front so exec needs no conversion."""
+
+    return tuple(os.fsencode(arg) for arg in args)
+
+
+def open_download_session() -> requests.Session:
+    """Create a keep-alive HTTP session sized for parallel range requests."""
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=RANGE_WORKERS + 1
+    )
+    session.mount('https://', adapter)
+    return session
+
+
+def _content_range_total(response: requests.Response) -> int | None:
+    """Return the full resource size advertised by a 206 response."""
+
+    _, _, total = response.headers.get('Content-Range', '').rpartition('/')
+    return int(total) if total.isdigit() else None
+
+
+def _fetch_range(session: requests.Session, url: str, start: int, end: int) -> bytes:
+    response = session.get(
+        url,
+        # Ranges address the raw bytes, so the body must not be compressed.
+        headers={'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'},
+        timeout=DOWNLOAD_TIMEOUT,
+    )
+    response.raise_for_status()
+    if len(response.content) != end - start + 1:
+        raise requests.RequestException(
+            f'Range {start}-{end} returned {len(response.content)} bytes.'
+        )
+    return response.content
+
+
+def prefetch_head(session: requests.Session, url: str) -> PrefetchedHead:
+    """Fetch the start of a download so its ffmpeg run can begin warm.
+
+    The range request also resolves Drive's redirect chain and reveals the
+    file size. If the server ignores ``Range`` nothing is buffered and the
+    file is later streamed in a single request instead.
+    """
+
+    response = session.get(
+        url,
+        # Later ranges start at len(data), so it must count undecoded bytes.
+        headers={
+            'Range': f'bytes=0-{PREFETCH_BYTES - 1}',
+            'Accept-Encoding': 'identity',
+        },
+        stream=True,
+        timeout=DOWNLOAD_TIMEOUT,
+    )
+    with response:
+        response.raise_for_status()
+        total = _content_range_total(response)
+        if response.status_code != 206 or total is None:
+            return PrefetchedHead(url=url, data=b'')
+        return PrefetchedHead(url=response.url, data=response.content, total=total)
+
+
+class HeadPrefetcher:
+    """Fetches the head of a pass's next piped file while another plays.
+
+    At most one head is held. ``take`` hands out the head for a file, warm
+    when it is the one being prefetched, and starts on the first piped file
+    among those that follow it, so the first file of each concat session is
+    warmed by the previous one.
+    """
+
+    def __init__(self, session: requests.Session, catalog: SourceCatalog) -> None:
+        self._session = session
+        self._catalog = catalog
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending: Tuple[str, Future] | None = None
+
+    def _submit(self, file_info: Dict[str, str]) -> Future:
+        url = DOWNLOAD_URL.format(file_id=file_info['id'])
+        return self._pool.submit(prefetch_head, self._session, url)
+
+    def warm(self, upcoming: Iterable[Dict[str, str]]) -> None:
+        """Prefetch the first piped file in ``upcoming`` unless already held.
+
+        The search stops at a file whose layout is not known yet.
+        """
+
+        for file_info in upcoming:
+            if self._catalog.can_pipe(file_info):
+                break
+            if not self._catalog.layout_known(file_info):
+                return
+        else:
+            return
+        if self._pending is not None:
+            if self._pending[0] == file_info['id']:
+                return
+            self._pending[1].cancel()
+        self._pending = (file_info['id'], self._submit(file_info))
+
+    def take(
+        self, file_info: Dict[str, str], upcoming: Iterable[Dict[str, str]]
+    ) -> Future:
+        """Return the head of ``file_info`` and begin warming the next one."""
+
+        pending, self._pending = self._pending, None
+        if pending is not None and pending[0] == file_info['id']:
+            head = pending[1]
+        else:
+            # ffmpeg skipped ahead, e.g. after exiting early; start cold.
+            if pending is not None:
+                pending[1].cancel()
+            head = self._submit(file_info)
+        self.warm(upcoming)
+        return head
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def fetch_header(session: requests.Session, url: str) -> bytes:
+    """Return up to the first LAYOUT_PROBE_BYTES of a download.
+
+    The body is read through ``iter_content`` so stalls and broken
+    connections surface as ``requests.RequestException``.
+    """
+
+    response = session.get(
+        url,
+        headers={
+            'Range': f'bytes=0-{LAYOUT_PROBE_BYTES - 1}',
+            'Accept-Encoding': 'identity',
+        },
+        stream=True,
+        timeout=DOWNLOAD_TIMEOUT,
+    )
+    with response:
+        response.raise_for_status()
+        header = b''
+        for chunk in response.iter_content(LAYOUT_PROBE_BYTES):
+            header += chunk
+            if len(header) >= LAYOUT_PROBE_BYTES:
+                break
+        return header[:LAYOUT_PROBE_BYTES]
+
+
+def is_pipe_safe(header: bytes) -> bool:
+    """Return True when a file starting with ``header`` can be read from a pipe.
+
+    Walks the top-level ISO BMFF boxes: an MP4/MOV is only safe when
+    ``moov`` comes before ``mdat``. Other containers are demuxed front to
+    back. A layout that cannot be settled within ``header`` is not safe.
+    """
+
+    if len(header) < 8:
+        return False
+    if header[4:8] not in MP4_LEADING_BOXES:
+        return True
+    offset = 0
+    while offset + 8 <= len(header):
+        size, kind = struct.unpack_from('>I4s', header, offset)
+        if kind == b'moov':
+            return True
+        if kind == b'mdat':
+            return False
+        if size == 1:
+            if offset + 16 > len(header):
+                break
+            (size,) = struct.unpack_from('>Q', header, offset + 8)
+        if size < 8:
+            # Zero means the box runs to the end of the file.
+            break
+        offset += size
+    return False
+
+
+def iter_drive_bytes(
+    session: requests.Session, head: PrefetchedHead
+) -> Iterator[List[bytes]]:
+    """Yield a download's bytes in order as batches of ready chunks.
+
+    The prefetched head is emitted first; the remaining ranges are fetched
+    in parallel against the already-resolved URL.
+    """
+
+    if head.total is None:
+        response = session.get(head.url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        with response:
+            response.raise_for_status()
+            for chunk in response.iter_content(RANGE_CHUNK_SIZE):
+                yield [chunk]
+        return
+
+    yield [head.data]
+    total = head.total
+    pending: deque = deque()
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as pool:
+        try:
+            for start in range(len(head.data), total, RANGE_CHUNK_SIZE):
+                end = min(start + RANGE_CHUNK_SIZE, total) - 1
+                pending.append(
+                    pool.submit(_fetch_range, session, head.url, start, end)
                 )
-        except Exception as exc:  # noqa: BLE001 - catch runtime issues to continue
-            logging.exception("Error streaming %s: %s", name, exc)
+                if len(pending) >= RANGE_WORKERS * 2:
+                    yield _pop_ready(pending)
+            while pending:
+                yield _pop_ready(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _pop_ready(pending: deque) -> List[bytes]:
+    """Wait for the oldest range, then take any followers that already landed."""
+
+    batch = [pending.popleft().result()]
+    while pending and pending[0].done():
+        batch.append(pending.popleft().result())
+    return batch
+
+
+def _write_all(fd: int, buffers: Sequence[bytes]) -> None:
+    """Write every buffer to ``fd``, batching into one syscall where possible."""
+
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    while views:
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, views)
+        else:
+            written = os.write(fd, views[0])
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+
+def feed_pipe(
+    session: requests.Session, head: Future, pipe: BinaryIO, name: str
+) -> None:
+    """Download a file into ffmpeg's stdin, closing it once the file ends."""
+
+    try:
+        for batch in iter_drive_bytes(session, head.result()):
+            _write_all(pipe.fileno(), batch)
+    except BrokenPipeError:
+        logging.debug("ffmpeg stopped reading %s before the download finished.", name)
+    except requests.RequestException as exc:
+        logging.warning("Failed to download %s: %s", name, exc)
+    finally:
+        with contextlib.suppress(OSError):
+            pipe.close()
+
+
+def _concat_quote(value: str) -> str:
+    """Quote a path or URL for an ffconcat ``file`` directive."""
+
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def write_concat_playlist(
+    workdir: Path, files: List[Dict[str, str]], catalog: SourceCatalog, start: int
+) -> Tuple[Path, List[Tuple[int, Dict[str, str], Path]]]:
+    """Write an ffconcat playlist for ``files`` and return it with its FIFOs.
+
+    Files the catalog knows to be pipe-safe get a named pipe fed by the
+    range downloader; the FIFOs come back as ``(position, file, path)``,
+    counting positions in the pass from ``start``. The rest, every file on
+    platforms without ``os.mkfifo`` and any file whose FIFO cannot be
+    created, are listed by Drive URL so ffmpeg can seek in them.
+    """
+
+    entries: List[str] = []
+    fifos: List[Tuple[int, Dict[str, str], Path]] = []
+    for position, file_info in enumerate(files, start=start):
+        if hasattr(os, 'mkfifo') and catalog.can_pipe(file_info):
+            fifo = workdir / f'{position:05d}.fifo'
+            try:
+                os.mkfifo(fifo)
+            except OSError as exc:
+                logging.warning("Unable to create a pipe in %s: %s", workdir, exc)
+            else:
+                fifos.append((position, file_info, fifo))
+                entries.append(str(fifo))
+                continue
+        entries.append(DOWNLOAD_URL.format(file_id=file_info['id']))
+
+    playlist = workdir / f'{start:05d}.ffconcat'
+    playlist.write_text(
+        'ffconcat version 1.0\n'
+        + ''.join(f"file {_concat_quote(entry)}\n" for entry in entries),
+        encoding='utf-8',
+    )
+    return playlist, fifos
+
+
+def _grow_pipe(fd: int) -> None:
+    """Raise a pipe's kernel buffer to PIPE_BUFFER_SIZE where Linux allows it."""
+
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    with contextlib.suppress(OSError):
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+
+
+def _drain(stream: BinaryIO, tail: OutputTail) -> None:
+    """Consume ffmpeg's stderr in large raw reads so it never blocks."""
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    fd = stream.fileno()
+    with stream:
+        while True:
+            data = os.read(fd, STDERR_READ_SIZE)
+            if not data:
+                break
+            tail.append(data)
+            if debug:
+                logging.debug("ffmpeg: %s", data.decode(errors='replace').rstrip())
+
+
+def feed_playlist(
+    session: requests.Session,
+    prefetcher: HeadPrefetcher,
+    fifos: List[Tuple[int, Dict[str, str], Path]],
+    after: List[Dict[str, str]],
+    total: int,
+    stop: threading.Event,
+) -> int:
+    """Download each file into its FIFO as ffmpeg reaches it in the playlist.
+
+    ``after`` lists the files of the pass that follow this playlist, so the
+    last piped file can warm up the first of the next session.
+    Returns how many FIFOs ffmpeg never opened before ``stop`` was set.
+    """
+
+    for index, (position, file_info, fifo) in enumerate(fifos):
+        # Taking the head also warms up the following video while this plays.
+        upcoming = [following for _, following, _ in fifos[index + 1:]] + after
+        head = prefetcher.take(file_info, upcoming)
+
+        # Opening a FIFO for writing blocks until ffmpeg opens it to read.
+        pipe = open(fifo, 'wb', buffering=0)
+        if stop.is_set():
+            pipe.close()
+            return len(fifos) - index
+        _grow_pipe(pipe.fileno())
+        name = file_info.get('name', file_info['id'])
+        logging.info("Streaming %s/%s: %s", position, total, name)
+        feed_pipe(session, head, pipe, name)
+    return 0
+
+
+def _unblock_fifos(fifos: Iterable[Path]) -> None:
+    """Open each FIFO for reading so a writer stuck in ``open`` wakes up."""
+
+    for fifo in fifos:
+        with contextlib.suppress(OSError):
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+
+
+def _compile_argv(config: StreamConfig) -> ArgvTemplate:
+    """Resolve everything in the ffmpeg argv that is fixed for ``config``."""
+
+    output = (*_argv('-f', 'tee'), config.tee_output)
+    encoder = select_video_encoder(config.video_encoder)
+    encode_args = VIDEO_ENCODERS[encoder]
+    if config.share_cores and encoder == 'libx264':
+        encode_args = (*encode_args, '-threads', str(ENCODER_THREADS))
+    return ArgvTemplate(
+        prefix=_argv(
+            ensure_ffmpeg_available(), '-re',
+            '-f', 'concat', '-safe', '0',
+            '-protocol_whitelist', 'file,http,https,tcp,tls',
+            '-i',
+        ),
+        encode_suffix=(
+            *_argv(*encode_args, *AUDIO_ENCODE_ARGS),
+            *output,
+        ),
+        passthrough_suffix=(*_argv(*PASSTHROUGH_ARGS), *output),
+    )
+
+
+async def _stop_feeder(
+    feeder: asyncio.Future,
+    fifos: List[Tuple[int, Dict[str, str], Path]],
+    stop: threading.Event,
+) -> int:
+    """Stop ``feed_playlist`` and return how many FIFOs were left unread."""
+
+    stop.set()
+    while not feeder.done():
+        _unblock_fifos(fifo for _, _, fifo in fifos)
+        await asyncio.wait([feeder], timeout=0.5)
+    return await feeder
+
+
+def _files_after(
+    files: List[Dict[str, str]], played: Dict[str, str] | None
+) -> List[Dict[str, str]]:
+    """Return the files that follow ``played`` in a name-ordered playlist."""
+
+    if played is None:
+        return files
+    for index, file_info in enumerate(files):
+        if file_info['id'] == played['id']:
+            return files[index + 1:]
+    # The file left the playlist; resume after where its name would sort.
+    return files[bisect.bisect_right(files, _playlist_key(played), key=_playlist_key):]
+
+
+async def stream_videos(
+    current: Callable[[], List[Dict[str, str]]],
+    config: StreamConfig,
+    argv: ArgvTemplate,
+    catalog: SourceCatalog,
+) -> bool:
+    """Broadcast the playlist, one long-lived ffmpeg process per file group.
+
+    ffmpeg reads each group of same-format videos via the concat demuxer,
+    so the encoder and the RTMP sessions survive clip boundaries within a
+    group instead of reconnecting per file. Each group is cut from the
+    latest playlist ``current`` returns just before it starts, so Drive
+    changes apply from the next session of the pass. Only the next
+    SETTLE_AHEAD files are settled before a session; the rest of the pass
+    is settled in the background while earlier groups play.
+    Returns True when at least one group's ffmpeg exited cleanly.
+    """
+
+    if not current():
+        return False
+
+    catalog.begin_pass()
+    try:
+        workdir = tempfile.TemporaryDirectory(
+            prefix='xstream-', ignore_cleanup_errors=True
+        )
+    except OSError as exc:
+        logging.error("Unable to create a working directory for ffmpeg: %s", exc)
+        return False
+    with workdir, open_download_session() as session:
+        prefetcher = HeadPrefetcher(session, catalog)
+        try:
+            played = None
+            streamed = False
+            while True:
+                files = current()
+                remaining = _files_after(files, played)
+                if not remaining:
+                    break
+                catalog.settle_later(remaining)
+                await asyncio.to_thread(catalog.settle, remaining[:SETTLE_AHEAD])
+                group = catalog.group(remaining)[0]
+                prefetcher.warm(remaining)
+                streamed = await _stream_group(
+                    group, remaining[len(group):],
+                    len(files) - len(remaining) + 1, len(files),
+                    Path(workdir.name), session, prefetcher, argv, catalog,
+                ) or streamed
+                played = group[-1]
+        finally:
+            await asyncio.to_thread(prefetcher.close)
+    return streamed
+
+
+async def _stream_group(
+    group: List[Dict[str, str]],
+    after: List[Dict[str, str]],
+    start: int,
+    total: int,
+    workdir: Path,
+    session: requests.Session,
+    prefetcher: HeadPrefetcher,
+    argv: ArgvTemplate,
+    catalog: SourceCatalog,
+) -> bool:
+    """Play one group of the pass through a single ffmpeg concat session.
+
+    The blocking download and stderr loops run in worker threads. Returns
+    True when ffmpeg exited cleanly.
+    """
+
+    stop = threading.Event()
+    fifos: List[Tuple[int, Dict[str, str], Path]] = []
+    feeder = None
+    returncode = None
+    try:
+        playlist, fifos = write_concat_playlist(workdir, group, catalog, start)
+        passthrough = catalog.can_stream_copy(group)
+        end = start + len(group) - 1
+        logging.info(
+            "Starting ffmpeg for %s of %s%s.",
+            f'video {start}' if end == start else f'videos {start}-{end}',
+            total,
+            '; relaying H.264/AAC without re-encoding' if passthrough else '',
+        )
+        # Piped files are logged as the feeder reaches them; ffmpeg reads the
+        # rest from Drive itself, so they are logged when the playlist is set.
+        piped = {position for position, _, _ in fifos}
+        for position, file_info in enumerate(group, start=start):
+            if position not in piped:
+                logging.info(
+                    "Queued %s/%s: %s; ffmpeg reads it from Drive.",
+                    position,
+                    total,
+                    file_info.get('name', file_info['id']),
+                )
+        ffmpeg_cmd = argv.build(playlist, passthrough=passthrough)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Running command: %s", b' '.join(ffmpeg_cmd).decode())
+
+        # Own the stderr pipe so it can be enlarged before ffmpeg writes.
+        read_fd, write_fd = os.pipe()
+        stderr = os.fdopen(read_fd, 'rb', buffering=0)
+        _grow_pipe(write_fd)
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *ffmpeg_cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=write_fd,
+                # Python opens descriptors non-inheritable, so close_fds
+                # buys nothing here; leaving it off (and not starting a
+                # new session) lets subprocess use posix_spawn.
+                close_fds=False,
+            )
+        except BaseException:
+            stderr.close()
+            raise
+        finally:
+            os.close(write_fd)
+
+        stderr_tail = OutputTail()
+        drainer = asyncio.ensure_future(asyncio.to_thread(_drain, stderr, stderr_tail))
+        if fifos:
+            feeder = asyncio.ensure_future(
+                asyncio.to_thread(
+                    feed_playlist, session, prefetcher, fifos, after, total, stop
+                )
+            )
+        try:
+            returncode = await proc.wait()
+        except BaseException:
+            # Do not leave ffmpeg publishing if we are interrupted.
+            proc.terminate()
+            await proc.wait()
+            raise
+        await drainer
+        if feeder is not None:
+            remaining = await _stop_feeder(feeder, fifos, stop)
+            if remaining:
+                logging.error(
+                    "ffmpeg exited before reaching %s of %s piped videos.",
+                    remaining,
+                    len(fifos),
+                )
+        if returncode != 0:
+            logging.warning(
+                "ffmpeg exited with code %s while streaming the playlist:\n%s",
+                returncode,
+                '\n'.join(stderr_tail.lines()),
+            )
+    except Exception as exc:  # noqa: BLE001 - catch runtime issues to continue
+        logging.exception("Error streaming playlist: %s", exc)
+    finally:
+        if feeder is not None:
+            # Already reported above if the feeder itself failed.
+            with contextlib.suppress(Exception):
+                await _stop_feeder(feeder, fifos, stop)
+    return returncode == 0
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -196,14 +1481,45 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         '--refresh-interval',
         type=int,
-        help='Seconds to wait before checking Drive for new files.',
+        help='Seconds between background checks of Drive for new files.',
     )
     parser.add_argument(
         '--stream-key',
         help='Local RTMP stream key. Defaults to RTMP_STREAM_KEY env or "stream".',
     )
+    parser.add_argument(
+        '--local-url',
+        help='Override the local output, e.g. an srt:// or udp:// edge that '
+        'relays to RTMP. Defaults to LOCAL_OUTPUT_URL env or '
+        'rtmp://localhost/live/<stream key>.',
+    )
     parser.add_argument('--youtube-url', help='Optional RTMP endpoint for YouTube.')
     parser.add_argument('--twitch-url', help='Optional RTMP endpoint for Twitch.')
+    parser.add_argument(
+        '--video-encoder',
+        choices=['auto', *VIDEO_ENCODERS],
+        help='H.264 encoder to use. Defaults to VIDEO_ENCODER env or "auto", '
+        'which prefers available hardware encoders over libx264.',
+    )
+    parser.add_argument(
+        '--channel',
+        action='append',
+        metavar='FOLDER_ID:STREAM_KEY',
+        help='Stream another Drive folder to the local RTMP server under its '
+        'own stream key. Repeatable; defaults to the comma-separated CHANNELS '
+        'env.',
+    )
+    parser.add_argument(
+        '--max-streams',
+        type=int,
+        help='Maximum channels running ffmpeg at once; the rest wait their turn. '
+        'Defaults to MAX_STREAMS env or one per four CPU cores.',
+    )
+    parser.add_argument(
+        '--state-dir',
+        help='Directory for the cached Drive listing. Defaults to STATE_DIR env '
+        'or ~/.cache/xstream.',
+    )
     parser.add_argument(
         '--once',
         action='store_true',
@@ -217,13 +1533,59 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def run(config: StreamConfig, *, drive_service, run_once: bool) -> None:
-    """Main streaming loop."""
+async def _acquire_slot(slots) -> None:
+    """Take one of the shared ffmpeg slots without blocking the event loop."""
+
+    if slots.acquire(block=False):
+        return
+    logging.info("All stream slots are busy; waiting for another channel's pass.")
+    # Wait in short steps so an interrupted run never leaves a thread blocked.
+    while not await asyncio.to_thread(slots.acquire, True, 1.0):
+        pass
+
+
+async def run(
+    config: StreamConfig, *, drive_service, run_once: bool, slots=None
+) -> None:
+    """Coordinate Drive polling and broadcasting for one channel.
+
+    Drive is polled by its own task every ``refresh_interval`` seconds, and
+    each ffmpeg session of a pass is cut from the latest result, so a long
+    pass never plays a stale playlist past its current session. The end of
+    each pass triggers an immediate re-poll and the next pass starts from
+    its result. A pass in
+    which ffmpeg never exited cleanly is instead followed by a backoff of
+    RETRY_DELAY seconds, doubling up to ``refresh_interval``. When
+    ``slots`` is given, each pass holds one of its semaphore slots.
+    """
 
     logging.info("Drive Auto-Stream initialised. Monitoring folder %s.", config.folder_id)
+    playlist = DrivePlaylist(config.folder_id, config.state_dir)
+    argv_template = _compile_argv(config)
+    catalog = SourceCatalog()
+    repoll = asyncio.Event()
+    refreshed = asyncio.Event()
+    latest: List[Dict[str, str]] = []
+    failed_passes = 0
+
+    async def poll_drive() -> None:
+        nonlocal latest
+        while True:
+            try:
+                # Drive calls block, so they run off the event loop.
+                latest = await asyncio.to_thread(playlist.refresh, drive_service)
+            except Exception as exc:  # noqa: BLE001 - keep polling after failures
+                logging.exception("Unable to refresh the Drive playlist: %s", exc)
+            refreshed.set()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(repoll.wait(), config.refresh_interval)
+            repoll.clear()
+
+    poller = asyncio.ensure_future(poll_drive())
     try:
         while True:
-            files = fetch_drive_videos(drive_service, config.folder_id)
+            await refreshed.wait()
+            files = latest
             if not files:
                 logging.warning(
                     "No videos found. Retrying in %s seconds...",
@@ -231,40 +1593,133 @@ def run(config: StreamConfig, *, drive_service, run_once: bool) -> None:
                 )
                 if run_once:
                     break
-                time.sleep(config.refresh_interval)
+                refreshed.clear()
                 continue
 
             logging.info("Found %s videos. Beginning broadcast...", len(files))
-            stream_videos(files, config)
+            if slots is not None:
+                await _acquire_slot(slots)
+            try:
+                streamed = await stream_videos(
+                    lambda: latest, config, argv_template, catalog
+                )
+            finally:
+                if slots is not None:
+                    slots.release()
 
             if run_once:
                 logging.info("Single-pass run complete.")
                 break
 
-            minutes = config.refresh_interval // 60
-            logging.info(
-                "Playlist done. Rechecking in %s minute%s.",
-                minutes or config.refresh_interval,
-                '' if minutes == 1 else 's',
-            )
-            time.sleep(config.refresh_interval)
+            if streamed:
+                failed_passes = 0
+                logging.info("Playlist done. Checking Drive before the next pass.")
+            else:
+                failed_passes += 1
+                delay = min(
+                    config.refresh_interval, RETRY_DELAY * 2 ** (failed_passes - 1)
+                )
+                logging.warning(
+                    "No ffmpeg session completed this pass. Retrying in %s seconds...",
+                    delay,
+                )
+                await asyncio.sleep(delay)
+            # The next iteration waits for this re-poll, not the timer.
+            refreshed.clear()
+            repoll.set()
+    finally:
+        catalog.close()
+        poller.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await poller
+
+
+def serve(
+    config: StreamConfig, *, drive_service, run_once: bool, slots=None
+) -> None:
+    """Run one channel's coordinator until it finishes or is interrupted."""
+
+    try:
+        asyncio.run(
+            run(config, drive_service=drive_service, run_once=run_once, slots=slots)
+        )
     except KeyboardInterrupt:
         logging.info("Received interrupt. Shutting down cleanly...")
 
 
+# Semaphore shared by the channel workers, set by _init_worker.
+_stream_slots = None
+
+
+def _init_worker(log_level: int, slots) -> None:
+    """Process-pool initializer that prepares a channel worker."""
+
+    global _stream_slots
+    # Spawned workers do not inherit the parent's logging configuration.
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    _stream_slots = slots
+
+
+def _run_channel(config: StreamConfig, run_once: bool) -> None:
+    """Process-pool entry point that streams a single channel."""
+
+    serve(
+        config,
+        drive_service=load_drive_service(config),
+        run_once=run_once,
+        slots=_stream_slots,
+    )
+
+
+def run_channels(channels: List[StreamConfig], *, run_once: bool) -> None:
+    """Stream several channels concurrently, each in its own worker process.
+
+    Each channel runs sequentially inside one worker, so its RTMP stream
+    key only ever sees one ffmpeg at a time. Every channel gets a worker,
+    but at most ``max_streams`` of them run an ffmpeg pass together; the
+    others wait for a free slot before their next pass.
+    """
+
+    context = multiprocessing.get_context()
+    slots = context.BoundedSemaphore(channels[0].max_streams)
+    log_level = logging.getLogger().getEffectiveLevel()
+    with ProcessPoolExecutor(
+        max_workers=len(channels),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(log_level, slots),
+    ) as pool:
+        futures = {
+            pool.submit(_run_channel, channel, run_once): channel
+            for channel in channels
+        }
+        try:
+            for future in as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    logging.error(
+                        "Channel %s stopped: %s", futures[future].stream_key, exc
+                    )
+        except KeyboardInterrupt:
+            # Workers share the terminal's process group and stop themselves.
+            logging.info("Received interrupt. Shutting down cleanly...")
+
+
 def main(argv: List[str] | None = None) -> int:
     parser = build_parser()
     args = parser.parse_args(argv)
 
     logging.basicConfig(
         level=getattr(logging, args.log_level.upper(), logging.INFO),
-        format='%(asctime)s | %(levelname)s | %(message)s',
+        format=LOG_FORMAT,
     )
 
     try:
         ensure_ffmpeg_available()
         config = StreamConfig.from_sources(args)
         drive_service = load_drive_service(config)
+        encoder = select_video_encoder(config.video_encoder)
+        logging.info("Using video encoder %s.", encoder)
     except ConfigurationError as exc:
         logging.error("Configuration error: %s", exc)
         return 1
@@ -272,7 +1727,11 @@ def main(argv: List[str] | None = None) -> int:
         logging.exception("Unable to initialise Google Drive service: %s", exc)
         return 1
 
-    run(config, drive_service=drive_service, run_once=args.once)
+    channels = config.channel_configs()
+    if len(channels) == 1:
+        serve(config, drive_service=drive_service, run_once=args.once)
+    else:
+        run_channels(channels, run_once=args.once)
     return 0
 
 
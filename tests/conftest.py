@@ -0,0 +1,95 @@
+import struct
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+import requests
+
+# drive_autostream is a top-level script, not an installed package.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import drive_autostream as da  # noqa: E402
+from fakes import H264, HEVC  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    """Fail Drive downloads and probes unless a test stands in for them."""
+
+    def fetch_header(session, url):
+        raise requests.ConnectionError('offline')
+
+    def probe_source(url):
+        raise OSError('offline')
+
+    monkeypatch.setattr(da, 'fetch_header', fetch_header)
+    monkeypatch.setattr(da, 'probe_source', probe_source)
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """A SourceCatalog whose probes report a fixed format per file ID."""
+
+    formats = {'a': H264, 'b': H264, 'c': HEVC, 'd': H264}
+
+    def probe(url):
+        source_format = formats.get(url.rpartition('=')[2])
+        if source_format is None:
+            raise ValueError('probe failed')
+        return source_format
+
+    monkeypatch.setattr(da, 'probe_source', probe)
+    return da.SourceCatalog()
+
+
+MOOV = struct.pack('>I4s', 8, b'moov')
+# Reads every piped entry of the playlist, then logs how many entries it had.
+FAKE_FFMPEG = textwrap.dedent(
+    """
+    import sys
+
+    playlist = sys.argv[1]
+    entries = [
+        line[5:].strip().strip("'")
+        for line in open(playlist)
+        if line.startswith('file ')
+    ]
+    for entry in entries:
+        if entry.endswith('.fifo'):
+            with open(entry, 'rb') as fifo:
+                fifo.read()
+    with open(sys.argv[2], 'a') as log:
+        log.write('%s\\n' % len(entries))
+    sys.exit(int(sys.argv[3]))
+    """
+)
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    """Patch downloads and ffmpeg; return a reader of the sessions it ran."""
+
+    script = tmp_path / 'ffmpeg.py'
+    script.write_text(FAKE_FFMPEG)
+    sessions = tmp_path / 'sessions.log'
+    sessions.touch()
+    monkeypatch.setattr(da, 'probe_source', lambda url: H264)
+    monkeypatch.setattr(da, 'fetch_header', lambda session, url: MOOV)
+    monkeypatch.setattr(
+        da,
+        'prefetch_head',
+        lambda session, url: da.PrefetchedHead(url=url, data=b'data', total=4),
+    )
+    monkeypatch.setattr(da, 'iter_drive_bytes', lambda session, head: [[head.data]])
+
+    def use_exit_code(code):
+        template = da.ArgvTemplate(
+            prefix=da._argv(sys.executable, str(script)),
+            encode_suffix=da._argv(str(sessions), str(code)),
+            passthrough_suffix=da._argv(str(sessions), str(code)),
+        )
+        monkeypatch.setattr(da, '_compile_argv', lambda config: template)
+        return lambda: [int(line) for line in sessions.read_text().split()]
+
+    return use_exit_code
@@ -0,0 +1,113 @@
+"""Stand-ins for the Drive v3 service and small helpers shared by the tests."""
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import drive_autostream as da
+
+FOLDER = 'folder'
+H264 = da.SourceFormat('h264', 1280, 720, 'yuv420p', 'High', 'aac', '44100', 2)
+HEVC = da.SourceFormat('hevc', 1280, 720, 'yuv420p', 'Main', 'aac', '44100', 2)
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+class FakeDrive:
+    """In-memory stand-in for the Drive v3 files and changes resources."""
+
+    def __init__(self, files=()):
+        self.listing = list(files)
+        self.page_size = 1000
+        self.pending = []
+        self.token = 1
+        self.reject_token = None
+        # Called from the polling thread with the running changes.list count.
+        self.on_poll = None
+        self.calls = {'files.list': 0, 'changes.list': 0, 'getStartPageToken': 0}
+
+    def files(self):
+        return FakeFiles(self)
+
+    def changes(self):
+        return FakeChanges(self)
+
+    def add_change(
+        self,
+        file_id,
+        name=None,
+        *,
+        parents=(FOLDER,),
+        trashed=False,
+        removed=False,
+        md5=None,
+    ):
+        change = {'fileId': file_id, 'removed': removed}
+        if name is not None:
+            change['file'] = {
+                'id': file_id,
+                'name': name,
+                'mimeType': 'video/mp4',
+                'parents': list(parents),
+                'trashed': trashed,
+            }
+            if md5 is not None:
+                change['file']['md5Checksum'] = md5
+        self.pending.append(change)
+
+
+class FakeFiles:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def list(self, pageSize, pageToken=None, **kwargs):
+        drive = self._drive
+        drive.calls['files.list'] += 1
+        start = int(pageToken or 0)
+        end = start + min(pageSize, drive.page_size)
+        response = {'files': drive.listing[start:end]}
+        if end < len(drive.listing):
+            response['nextPageToken'] = str(end)
+        return FakeRequest(response)
+
+
+class FakeChanges:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def getStartPageToken(self):
+        self._drive.calls['getStartPageToken'] += 1
+        return FakeRequest({'startPageToken': str(self._drive.token)})
+
+    def list(self, pageToken, **kwargs):
+        drive = self._drive
+        drive.calls['changes.list'] += 1
+        if drive.on_poll is not None:
+            drive.on_poll(drive.calls['changes.list'])
+        if drive.reject_token is not None:
+            status, drive.reject_token = drive.reject_token, None
+            return FakeRequest(HttpError(httplib2.Response({'status': status}), b''))
+        changes, drive.pending = drive.pending, []
+        if changes:
+            drive.token += 1
+        return FakeRequest(
+            {'changes': changes, 'newStartPageToken': str(drive.token)}
+        )
+
+
+def video(file_id, name=None, md5=None):
+    entry = {'id': file_id, 'name': name or file_id}
+    if md5 is not None:
+        entry['md5Checksum'] = md5
+    return entry
+
+
+def names(files):
+    return [entry['name'] for entry in files]
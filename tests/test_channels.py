@@ -0,0 +1,68 @@
+"""Tests for channel configuration and the per-channel ffmpeg argv."""
+
+import pytest
+
+import drive_autostream as da
+from fakes import FOLDER
+
+
+def channel_config(tmp_path, **overrides):
+    return da.StreamConfig(
+        folder_id=FOLDER,
+        service_account_file=tmp_path / 'credentials.json',
+        youtube_url='rtmp://youtube/live2/key',
+        state_dir=tmp_path,
+        **overrides,
+    )
+
+
+@pytest.mark.parametrize('key', ['../../etc', 'a/b', 'a\\b', '..', '.'])
+def test_channel_keys_cannot_leave_the_state_dir(key):
+    with pytest.raises(da.ConfigurationError):
+        da._parse_channel(f'folder:{key}')
+
+
+def test_channel_configs_keep_state_per_key(tmp_path):
+    config = channel_config(
+        tmp_path, extra_channels=(da._parse_channel('other:second'),)
+    )
+    main, extra = config.channel_configs()
+    assert main.state_dir == tmp_path
+    assert extra.state_dir == tmp_path / 'second'
+    assert extra.tee_targets == ['rtmp://localhost/live/second']
+
+
+@pytest.fixture
+def encoder_args(monkeypatch):
+    monkeypatch.setattr(da, 'ensure_ffmpeg_available', lambda: '/usr/bin/ffmpeg')
+
+    def compile_encode_args(config):
+        return da._compile_argv(config).encode_suffix
+
+    return compile_encode_args
+
+
+def test_a_single_channel_uses_every_core(tmp_path, encoder_args):
+    config = channel_config(tmp_path, video_encoder='libx264')
+    assert b'-threads' not in encoder_args(config)
+
+
+def test_shared_hosts_cap_libx264_threads(tmp_path, encoder_args):
+    config = channel_config(
+        tmp_path,
+        video_encoder='libx264',
+        extra_channels=(da._parse_channel('other:second'),),
+    )
+    for channel in config.channel_configs():
+        args = encoder_args(channel)
+        assert args[args.index(b'-threads') + 1] == str(da.ENCODER_THREADS).encode()
+
+
+def test_hardware_encoders_are_not_capped(tmp_path, encoder_args):
+    config = channel_config(
+        tmp_path,
+        video_encoder='h264_nvenc',
+        extra_channels=(da._parse_channel('other:second'),),
+    )
+    for channel in config.channel_configs():
+        assert b'-threads' not in encoder_args(channel)
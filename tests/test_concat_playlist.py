@@ -0,0 +1,174 @@
+"""Tests for concat playlists: grouping, pipe layouts and the FIFO feeder."""
+
+import asyncio
+import errno
+import struct
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import drive_autostream as da
+from fakes import video
+
+
+def box(kind, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def test_non_mp4_containers_are_pipe_safe():
+    assert da.is_pipe_safe(b'\x1aE\xdf\xa3' + bytes(60))
+
+
+def test_moov_before_mdat_is_pipe_safe():
+    assert da.is_pipe_safe(box(b'ftyp', b'isom') + box(b'moov') + box(b'mdat'))
+
+
+def test_mdat_before_moov_is_not_pipe_safe():
+    assert not da.is_pipe_safe(box(b'ftyp', b'isom') + box(b'mdat') + box(b'moov'))
+
+
+def test_largesize_boxes_are_skipped():
+    free = struct.pack('>I4sQ', 1, b'free', 24) + bytes(8)
+    assert da.is_pipe_safe(box(b'ftyp') + free + box(b'moov'))
+
+
+@pytest.mark.parametrize(
+    'header',
+    [
+        b'\0\0\0',
+        box(b'ftyp') + struct.pack('>I4s', 1, b'free') + b'\0\0',
+        box(b'ftyp') + struct.pack('>I4s', 0, b'free'),
+        box(b'ftyp', bytes(8)) + box(b'free')[:6],
+    ],
+    ids=['short', 'truncated-largesize', 'to-end-of-file', 'truncated-box'],
+)
+def test_unsettled_layouts_are_not_pipe_safe(header):
+    assert not da.is_pipe_safe(header)
+
+
+def test_group_splits_runs_of_one_format(catalog):
+    files = [video(file_id) for file_id in 'abcdx']
+    catalog.settle(files)
+    groups = catalog.group(files)
+    assert [[entry['id'] for entry in group] for group in groups] == [
+        ['a', 'b'], ['c'], ['d'], ['x'],
+    ]
+
+
+def test_unprobed_files_play_on_their_own(catalog):
+    files = [video('a'), video('b')]
+    assert catalog.group(files) == [[files[0]], [files[1]]]
+
+
+class PipeCatalog:
+    """A catalog that reports every file as safe to pipe."""
+
+    def can_pipe(self, file_info):
+        return True
+
+    def can_stream_copy(self, files):
+        return False
+
+
+needs_fifos = pytest.mark.skipif(
+    not hasattr(da.os, 'mkfifo'), reason='needs named pipes'
+)
+
+
+@needs_fifos
+def test_playlist_pipes_known_safe_files(tmp_path):
+    playlist, fifos = da.write_concat_playlist(
+        tmp_path, [video('a'), video('b')], PipeCatalog(), start=3
+    )
+    assert [(position, path.name) for position, _, path in fifos] == [
+        (3, '00003.fifo'), (4, '00004.fifo'),
+    ]
+    assert playlist.read_text().splitlines() == [
+        'ffconcat version 1.0',
+        f"file '{tmp_path / '00003.fifo'}'",
+        f"file '{tmp_path / '00004.fifo'}'",
+    ]
+
+
+@needs_fifos
+def test_playlist_falls_back_to_urls_without_fifos(tmp_path, monkeypatch):
+    def mkfifo(path):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+    monkeypatch.setattr(da.os, 'mkfifo', mkfifo)
+    playlist, fifos = da.write_concat_playlist(
+        tmp_path, [video('a')], PipeCatalog(), start=1
+    )
+    assert fifos == []
+    assert da.DOWNLOAD_URL.format(file_id='a') in playlist.read_text()
+
+
+def test_a_failed_playlist_write_does_not_stop_the_pass(tmp_path, monkeypatch):
+    def write_concat_playlist(*args):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(da, 'write_concat_playlist', write_concat_playlist)
+    catalog = da.SourceCatalog()
+    argv = da.ArgvTemplate(prefix=(), encode_suffix=(), passthrough_suffix=())
+    streamed = asyncio.run(da.stream_videos(lambda: [video('a')], None, argv, catalog))
+    assert streamed is False
+
+
+class ReadyPrefetcher:
+    def take(self, file_info, upcoming):
+        head = Future()
+        head.set_result(da.PrefetchedHead(url=file_info['id'], data=b''))
+        return head
+
+
+@needs_fifos
+def test_stopping_the_feeder_unblocks_unopened_fifos(tmp_path):
+    _, fifos = da.write_concat_playlist(
+        tmp_path, [video('a'), video('b')], PipeCatalog(), start=1
+    )
+    stop = threading.Event()
+
+    async def feed_then_stop():
+        feeder = asyncio.ensure_future(
+            asyncio.to_thread(
+                da.feed_playlist, None, ReadyPrefetcher(), fifos, [], 2, stop
+            )
+        )
+        # ffmpeg never opens the pipes, so the feeder is stuck in open().
+        await asyncio.sleep(0.1)
+        assert not feeder.done()
+        return await asyncio.wait_for(da._stop_feeder(feeder, fifos, stop), 10)
+
+    assert asyncio.run(feed_then_stop()) == 2
+
+
+@needs_fifos
+def test_the_first_session_starts_before_the_rest_is_probed(fake_ffmpeg, monkeypatch):
+    sessions = fake_ffmpeg(0)
+    files = [video(str(index)) for index in range(2 * da.SETTLE_AHEAD)]
+    first = {entry['id'] for entry in files[:da.SETTLE_AHEAD]}
+    played = threading.Event()
+    stream_group = da._stream_group
+
+    async def stream_group_then_signal(*args):
+        try:
+            return await stream_group(*args)
+        finally:
+            played.set()
+
+    def probe(url):
+        # Probes past the first files only finish once a session has played.
+        if url.rpartition('=')[2] not in first:
+            assert played.wait(10)
+        return da.SourceFormat('h264')
+
+    monkeypatch.setattr(da, '_stream_group', stream_group_then_signal)
+    monkeypatch.setattr(da, 'probe_source', probe)
+    catalog = da.SourceCatalog()
+    try:
+        argv = da._compile_argv(None)
+        assert asyncio.run(da.stream_videos(lambda: files, None, argv, catalog))
+    finally:
+        catalog.close()
+    assert sessions() == [da.SETTLE_AHEAD, da.SETTLE_AHEAD]
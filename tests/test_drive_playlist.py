@@ -0,0 +1,92 @@
+"""Tests for DrivePlaylist, against an in-memory Drive service."""
+
+import json
+
+import pytest
+
+import drive_autostream as da
+from fakes import FOLDER, FakeDrive, names, video
+
+
+def test_first_refresh_lists_the_folder_in_name_order(tmp_path):
+    drive = FakeDrive([video('2', 'b'), video('1', 'a')])
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    assert names(playlist.refresh(drive)) == ['a', 'b']
+    assert drive.calls['files.list'] == 1
+
+
+def test_changes_are_applied_in_place(tmp_path):
+    drive = FakeDrive([video('1', 'a'), video('2', 'b'), video('3', 'c')])
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    playlist.refresh(drive)
+
+    drive.add_change('4', 'bb')
+    drive.add_change('1', 'd')
+    drive.add_change('2', 'b', parents=('elsewhere',))
+    drive.add_change('3', 'c', trashed=True)
+    drive.add_change('5', 'e')
+    drive.add_change('5', removed=True)
+    assert names(playlist.refresh(drive)) == ['bb', 'd']
+    assert drive.calls['files.list'] == 1
+
+
+@pytest.mark.parametrize('status', [400, 404])
+def test_rejected_page_token_relists_the_folder(tmp_path, status):
+    drive = FakeDrive([video('1', 'a')])
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    playlist.refresh(drive)
+
+    drive.listing.append(video('2', 'b'))
+    drive.reject_token = status
+    assert names(playlist.refresh(drive)) == ['a', 'b']
+    assert drive.calls['files.list'] == 2
+
+
+def test_other_api_errors_keep_the_last_playlist(tmp_path):
+    drive = FakeDrive([video('1', 'a')])
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    playlist.refresh(drive)
+
+    drive.reject_token = 500
+    assert names(playlist.refresh(drive)) == ['a']
+    assert drive.calls['files.list'] == 1
+
+
+def test_state_is_restored_from_state_dir(tmp_path):
+    drive = FakeDrive([video('1', 'a')])
+    da.DrivePlaylist(FOLDER, tmp_path).refresh(drive)
+    drive.add_change('2', 'b')
+
+    restored = da.DrivePlaylist(FOLDER, tmp_path)
+    assert names(restored.refresh(drive)) == ['a', 'b']
+    assert drive.calls['files.list'] == 1
+    assert (tmp_path / 'page_token').read_text() == str(drive.token)
+    assert names(json.loads((tmp_path / 'playlist.json').read_text())['files']) == [
+        'a', 'b',
+    ]
+
+
+def test_state_of_another_folder_is_ignored(tmp_path):
+    da.DrivePlaylist('other', tmp_path).refresh(FakeDrive([video('1', 'a')]))
+    drive = FakeDrive([video('2', 'b')])
+    assert names(da.DrivePlaylist(FOLDER, tmp_path).refresh(drive)) == ['b']
+    assert drive.calls['files.list'] == 1
+
+
+def test_new_revisions_replace_the_entry(tmp_path):
+    drive = FakeDrive([video('1', 'a', md5='old')])
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    playlist.refresh(drive)
+
+    drive.add_change('1', 'a', md5='old')
+    assert playlist.refresh(drive) == [video('1', 'a', md5='old')]
+    drive.add_change('1', 'a', md5='new')
+    assert playlist.refresh(drive) == [video('1', 'a', md5='new')]
+
+
+def test_listings_follow_every_page(tmp_path):
+    drive = FakeDrive([video(str(index), f'{index:02d}') for index in range(5)])
+    drive.page_size = 2
+    playlist = da.DrivePlaylist(FOLDER, tmp_path)
+    assert names(playlist.refresh(drive)) == ['00', '01', '02', '03', '04']
+    assert drive.calls['files.list'] == 3
@@ -0,0 +1,16 @@
+"""Tests for OutputTail, the bounded buffer of ffmpeg's stderr."""
+
+import drive_autostream as da
+
+
+def test_output_tail_keeps_only_the_last_bytes():
+    tail = da.OutputTail(limit=10)
+    for chunk in (b'aaaa\n', b'bbbb\n', b'cccc\n', b'dddd\n'):
+        tail.append(chunk)
+    assert tail.lines() == ['cccc', 'dddd']
+
+
+def test_output_tail_keeps_a_single_oversized_chunk():
+    tail = da.OutputTail(limit=4)
+    tail.append(b'frame=1\rframe=2\rframe=3')
+    assert tail.lines(2) == ['frame=2', 'frame=3']
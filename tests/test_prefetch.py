@@ -0,0 +1,70 @@
+"""Tests for the head prefetcher that warms the next piped file."""
+
+import pytest
+
+import drive_autostream as da
+from fakes import video
+
+
+class LayoutCatalog:
+    """A catalog whose layouts are given per file ID; None means unknown."""
+
+    def __init__(self, layouts):
+        self._layouts = layouts
+
+    def can_pipe(self, file_info):
+        return bool(self._layouts.get(file_info['id']))
+
+    def layout_known(self, file_info):
+        return self._layouts.get(file_info['id']) is not None
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    urls = []
+
+    def prefetch(session, url):
+        urls.append(url.rpartition('=')[2])
+        return da.PrefetchedHead(url=url, data=b'')
+
+    monkeypatch.setattr(da, 'prefetch_head', prefetch)
+    return urls
+
+
+def test_prefetcher_warms_the_next_piped_head(fetched):
+    a, b, c, d = map(video, 'abcd')
+    prefetcher = da.HeadPrefetcher(
+        None, LayoutCatalog({'a': True, 'b': False, 'c': True, 'd': True})
+    )
+    try:
+        prefetcher.warm([a, b, c, d])
+        prefetcher.take(a, [b, c, d]).result()
+        # b is read by ffmpeg from Drive, so c is warmed in its place.
+        prefetcher.take(c, [d]).result()
+        prefetcher.take(d, []).result()
+    finally:
+        prefetcher.close()
+    assert fetched == ['a', 'c', 'd']
+
+
+def test_prefetcher_stops_at_unknown_layouts(fetched):
+    a, b, c = map(video, 'abc')
+    prefetcher = da.HeadPrefetcher(
+        None, LayoutCatalog({'a': True, 'b': None, 'c': True})
+    )
+    try:
+        prefetcher.take(a, [b, c]).result()
+    finally:
+        prefetcher.close()
+    assert fetched == ['a']
+
+
+def test_skipping_ahead_fetches_the_requested_head(fetched):
+    a, b, c = map(video, 'abc')
+    prefetcher = da.HeadPrefetcher(None, LayoutCatalog(dict.fromkeys('abc', True)))
+    try:
+        prefetcher.take(a, [b, c]).result()
+        assert prefetcher.take(c, []).result().url.endswith('=c')
+    finally:
+        prefetcher.close()
+    assert fetched.count('a') == fetched.count('c') == 1
@@ -0,0 +1,91 @@
+"""Tests for the parallel range downloader that feeds ffmpeg."""
+
+import threading
+
+import pytest
+
+import drive_autostream as da
+
+PAYLOAD = bytes(range(256)) * 2
+
+
+@pytest.fixture
+def small_ranges(monkeypatch):
+    monkeypatch.setattr(da, 'RANGE_CHUNK_SIZE', 64)
+
+
+def test_ranges_are_yielded_in_order_when_they_land_out_of_order(
+    small_ranges, monkeypatch
+):
+    head = da.PrefetchedHead(url='resolved', data=PAYLOAD[:10], total=len(PAYLOAD))
+    starts = list(range(len(head.data), len(PAYLOAD), da.RANGE_CHUNK_SIZE))
+    fetched = {start: threading.Event() for start in starts}
+
+    def fetch_range(session, url, start, end):
+        assert url == 'resolved'
+        # Each range only lands once the one after it has (or the last one).
+        following = start + da.RANGE_CHUNK_SIZE
+        if following in fetched:
+            assert fetched[following].wait(10)
+        fetched[start].set()
+        return PAYLOAD[start:end + 1]
+
+    monkeypatch.setattr(da, '_fetch_range', fetch_range)
+    monkeypatch.setattr(da, 'RANGE_WORKERS', len(starts))
+    batches = list(da.iter_drive_bytes(None, head))
+    assert batches[0] == [head.data]
+    assert b''.join(b''.join(batch) for batch in batches) == PAYLOAD
+
+
+def test_pending_ranges_are_bounded(small_ranges, monkeypatch):
+    payload = PAYLOAD * 8
+    head = da.PrefetchedHead(url='resolved', data=b'', total=len(payload))
+    requested = []
+
+    def fetch_range(session, url, start, end):
+        requested.append(start)
+        return payload[start:end + 1]
+
+    monkeypatch.setattr(da, '_fetch_range', fetch_range)
+    chunks = da.iter_drive_bytes(None, head)
+    next(chunks)  # the (empty) head
+    next(chunks)
+    # At most RANGE_WORKERS * 2 ranges are in flight beyond the one yielded.
+    assert len(requested) <= da.RANGE_WORKERS * 2 + 1
+    assert len(requested) < len(payload) // da.RANGE_CHUNK_SIZE
+    chunks.close()
+
+
+class PartialWrites:
+    """Accept at most ``limit`` bytes per write call."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b''
+
+    def writev(self, fd, views):
+        return self.write(fd, b''.join(bytes(view) for view in views))
+
+    def write(self, fd, data):
+        data = bytes(data)[:self.limit]
+        self.data += data
+        return len(data)
+
+
+BUFFERS = [b'abc', b'', b'defghij', b'k', b'lmnopqrstu']
+
+
+@pytest.mark.skipif(not hasattr(da.os, 'writev'), reason='needs os.writev')
+def test_write_all_resumes_partial_vectored_writes(monkeypatch):
+    sink = PartialWrites(4)
+    monkeypatch.setattr(da.os, 'writev', sink.writev)
+    da._write_all(-1, BUFFERS)
+    assert sink.data == b''.join(BUFFERS)
+
+
+def test_write_all_without_writev_resumes_partial_writes(monkeypatch):
+    sink = PartialWrites(2)
+    monkeypatch.delattr(da.os, 'writev', raising=False)
+    monkeypatch.setattr(da.os, 'write', sink.write)
+    da._write_all(-1, BUFFERS)
+    assert sink.data == b''.join(BUFFERS)
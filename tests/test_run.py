@@ -0,0 +1,153 @@
+"""Tests for the per-channel coordinator, with Drive and ffmpeg stand-ins."""
+
+import asyncio
+import contextlib
+import logging
+
+import pytest
+
+import drive_autostream as da
+from fakes import FOLDER, H264, HEVC, FakeDrive, video
+
+needs_fifos = pytest.mark.skipif(
+    not hasattr(da.os, 'mkfifo'), reason='needs named pipes'
+)
+
+
+def stream_config(tmp_path, refresh_interval=600):
+    return da.StreamConfig(
+        folder_id=FOLDER,
+        service_account_file=tmp_path / 'credentials.json',
+        refresh_interval=refresh_interval,
+        state_dir=tmp_path / 'state',
+    )
+
+
+async def run_until(config, drive, stopped):
+    """Run one channel until ``stopped`` is set, then cancel it."""
+
+    task = asyncio.ensure_future(
+        da.run(config, drive_service=drive, run_once=False)
+    )
+    waiter = asyncio.ensure_future(stopped.wait())
+    await asyncio.wait(
+        [task, waiter], timeout=30, return_when=asyncio.FIRST_COMPLETED
+    )
+    waiter.cancel()
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    assert stopped.is_set()
+
+
+class Delays(list):
+    stop_after = None
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    """Record run's backoff sleeps instead of waiting them out.
+
+    ``stop_after(count, stopped)`` sets ``stopped`` at the count-th sleep
+    and holds that sleep open until the run is cancelled.
+    """
+
+    delays = Delays()
+    limit = {}
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) == limit.get('count'):
+            limit['stopped'].set()
+            await asyncio.Event().wait()
+
+    def stop_after(count, stopped):
+        limit.update(count=count, stopped=stopped)
+
+    monkeypatch.setattr(da.asyncio, 'sleep', sleep)
+    delays.stop_after = stop_after
+    return delays
+
+
+@needs_fifos
+def test_first_pass_shares_one_session(tmp_path, fake_ffmpeg):
+    sessions = fake_ffmpeg(0)
+    drive = FakeDrive([video('1', 'a'), video('2', 'b'), video('3', 'c')])
+    asyncio.run(
+        asyncio.wait_for(
+            da.run(stream_config(tmp_path), drive_service=drive, run_once=True), 30
+        )
+    )
+    assert sessions() == [3]
+
+
+def test_failed_passes_back_off(tmp_path, fake_ffmpeg, backoffs, monkeypatch):
+    sessions = fake_ffmpeg(1)
+    monkeypatch.setattr(da, 'RETRY_DELAY', 1)
+    drive = FakeDrive([video('1', 'a')])
+
+    async def main():
+        stopped = asyncio.Event()
+        backoffs.stop_after(4, stopped)
+        await run_until(stream_config(tmp_path, refresh_interval=6), drive, stopped)
+
+    asyncio.run(main())
+    # Doubling from RETRY_DELAY, capped at the refresh interval.
+    assert backoffs == [1, 2, 4, 6]
+    assert sessions() == [1, 1, 1, 1]
+    # Drive is re-polled once after each completed backoff.
+    assert drive.calls['changes.list'] == 3
+
+
+def test_played_passes_repoll_straight_away(tmp_path, fake_ffmpeg, backoffs):
+    sessions = fake_ffmpeg(0)
+    drive = FakeDrive([video('1', 'a')])
+
+    async def main():
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def on_poll(count):
+            if count == 2:
+                loop.call_soon_threadsafe(stopped.set)
+
+        drive.on_poll = on_poll
+        await run_until(stream_config(tmp_path), drive, stopped)
+
+    asyncio.run(main())
+    assert backoffs == []
+    assert sessions()[:2] == [1, 1]
+
+
+@needs_fifos
+def test_drive_changes_apply_to_sessions_not_yet_started(
+    fake_ffmpeg, monkeypatch, caplog
+):
+    sessions = fake_ffmpeg(0)
+    formats = {'a': H264, 'b': HEVC, 'c': HEVC, 'd': HEVC}
+    monkeypatch.setattr(
+        da, 'probe_source', lambda url: formats[url.rpartition('=')[2]]
+    )
+    playlist = [video('a'), video('c')]
+    stream_group = da._stream_group
+
+    async def stream_group_then_change(*args):
+        try:
+            return await stream_group(*args)
+        finally:
+            # A poll during the first session: c removed, b and d added.
+            playlist[:] = [video('a'), video('b'), video('d')]
+
+    monkeypatch.setattr(da, '_stream_group', stream_group_then_change)
+    catalog = da.SourceCatalog()
+    caplog.set_level(logging.INFO)
+    try:
+        argv = da._compile_argv(None)
+        assert asyncio.run(da.stream_videos(lambda: list(playlist), None, argv, catalog))
+    finally:
+        catalog.close()
+    assert sessions() == [1, 2]
+    assert [
+        record.getMessage() for record in caplog.records
+        if record.getMessage().startswith('Streaming ')
+    ] == ['Streaming 1/2: a', 'Streaming 2/3: b', 'Streaming 3/3: d']
@@ -0,0 +1,82 @@
+"""Tests for SourceCatalog's format probes and stream copy decisions."""
+
+import drive_autostream as da
+from fakes import H264, HEVC, video
+
+
+def test_can_stream_copy_needs_one_known_passthrough_format(catalog):
+    catalog.settle([video(file_id) for file_id in 'abcdx'])
+    assert catalog.can_stream_copy([video('a'), video('b'), video('d')])
+    assert not catalog.can_stream_copy([video('a'), video('c')])
+    assert not catalog.can_stream_copy([video('c')])
+    assert not catalog.can_stream_copy([video('x')])
+
+
+def test_failed_probes_are_retried_on_later_passes_up_to_the_limit(monkeypatch):
+    attempts = []
+
+    def probe(url):
+        attempts.append(url)
+        raise OSError('network down')
+
+    monkeypatch.setattr(da, 'probe_source', probe)
+    catalog = da.SourceCatalog()
+    for _ in range(da.PROBE_ATTEMPTS + 2):
+        catalog.begin_pass()
+        catalog.settle([video('a')])
+    assert len(attempts) == da.PROBE_ATTEMPTS
+
+
+def test_a_probe_that_recovers_on_the_next_pass_is_used(monkeypatch):
+    results = [OSError('network down'), H264]
+
+    def probe(url):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(da, 'probe_source', probe)
+    catalog = da.SourceCatalog()
+    catalog.settle([video('a')])
+    catalog.settle([video('a')])
+    assert not catalog.can_stream_copy([video('a')])
+    catalog.begin_pass()
+    catalog.settle([video('a')])
+    assert catalog.can_stream_copy([video('a')])
+
+
+def test_new_revisions_are_probed_again(monkeypatch):
+    formats = {'1': H264}
+    monkeypatch.setattr(da, 'probe_source', lambda url: formats['1'])
+    catalog = da.SourceCatalog()
+    catalog.settle([video('1', md5='old')])
+
+    formats['1'] = HEVC
+    catalog.settle([video('1', md5='new')])
+    assert catalog.can_stream_copy([video('1', md5='old')])
+    assert not catalog.can_stream_copy([video('1', md5='new')])
+    assert not catalog.can_stream_copy([video('1', md5='old'), video('1', md5='new')])
+
+
+def test_new_revisions_have_their_layout_checked_again(monkeypatch):
+    headers = {'old': b'\0\0\0\x08moov', 'new': b'\0\0\0\x08mdat'}
+    revision = ['old']
+    monkeypatch.setattr(
+        da, 'fetch_header', lambda session, url: headers[revision[0]]
+    )
+    catalog = da.SourceCatalog()
+    catalog.settle([video('1', md5='old')])
+    revision[0] = 'new'
+    catalog.settle([video('1', md5='new')])
+    assert catalog.can_pipe(video('1', md5='old'))
+    assert not catalog.can_pipe(video('1', md5='new'))
+
+
+def test_settle_later_checks_files_in_the_background(catalog):
+    files = [video(file_id) for file_id in 'abcd']
+    catalog.settle_later(files)
+    # Files already queued are waited on, not checked twice.
+    catalog.settle(files)
+    assert catalog.can_stream_copy(files[:2])
+    catalog.close()
@@ -0,0 +1,16 @@
+"""Tests for the per-destination muxers of the tee output."""
+
+import drive_autostream as da
+
+
+def test_tee_output_picks_the_muxer_per_scheme():
+    output = da.build_tee_output([
+        'srt://127.0.0.1:9000?mode=caller',
+        'UDP://127.0.0.1:9001',
+        'rtmp://a.rtmp.youtube.com/live2/key',
+    ])
+    assert output == (
+        b'[f=mpegts]srt://127.0.0.1:9000?mode=caller'
+        b'|[f=mpegts]UDP://127.0.0.1:9001'
+        b'|[f=flv]rtmp://a.rtmp.youtube.com/live2/key'
+    )